@@ -2,9 +2,6 @@ from ctypes import *
 
 #64-bit only
 DWORD     = c_ulong
-ULONG_PTR = POINTER(c_ulong)
-
-#taken from https://github.com/jleben/python-serial/blob/master/examples/scanwin32.py
 
 class GUID(Structure):
     _fields_ = [
@@ -13,19 +10,64 @@ class GUID(Structure):
         ('Data3', c_ushort),
         ('Data4', c_ubyte*8),
     ]
-    
-class SP_DEVICE_INTERFACE_DATA(Structure):
+
+UINT    = c_uint
+WPARAM  = c_ulonglong
+LPARAM  = c_longlong
+LRESULT = c_longlong
+
+WNDPROC = WINFUNCTYPE(LRESULT, c_void_p, UINT, WPARAM, LPARAM)
+
+HWND_MESSAGE = c_void_p(-3)
+
+WM_DEVICECHANGE             = 0x0219
+DBT_DEVICEARRIVAL           = 0x8000
+DBT_DEVICEREMOVECOMPLETE    = 0x8004
+DBT_DEVTYP_DEVICEINTERFACE  = 0x00000005
+DEVICE_NOTIFY_WINDOW_HANDLE = 0x00000000
+
+class WNDCLASSW(Structure):
     _fields_ = [
-        ('cbSize', DWORD),
-        ('InterfaceClassGuid', GUID),
-        ('Flags', DWORD),
-        ('Reserved', ULONG_PTR),
+        ('style', UINT),
+        ('lpfnWndProc', WNDPROC),
+        ('cbClsExtra', c_int),
+        ('cbWndExtra', c_int),
+        ('hInstance', c_void_p),
+        ('hIcon', c_void_p),
+        ('hCursor', c_void_p),
+        ('hbrBackground', c_void_p),
+        ('lpszMenuName', c_wchar_p),
+        ('lpszClassName', c_wchar_p),
     ]
 
-class SP_DEVINFO_DATA(Structure):
+class POINT(Structure):
     _fields_ = [
-        ('cbSize', DWORD),
-        ('ClassGuid', GUID),
-        ('DevInst', DWORD),
-        ('Reserved', ULONG_PTR),
-    ]
\ No newline at end of file
+        ('x', c_long),
+        ('y', c_long),
+    ]
+
+class MSG(Structure):
+    _fields_ = [
+        ('hwnd', c_void_p),
+        ('message', UINT),
+        ('wParam', WPARAM),
+        ('lParam', LPARAM),
+        ('time', DWORD),
+        ('pt', POINT),
+        ('lPrivate', DWORD),
+    ]
+
+class DEV_BROADCAST_DEVICEINTERFACE_W(Structure):
+    _fields_ = [
+        ('dbcc_size', DWORD),
+        ('dbcc_devicetype', DWORD),
+        ('dbcc_reserved', DWORD),
+        ('dbcc_classguid', GUID),
+        ('dbcc_name', c_wchar * 1),
+    ]
+
+GUID_DEVINTERFACE_USB_DEVICE = GUID(0xA5DCBF10, 0x6530, 0x11D2, (c_ubyte * 8)(0x90, 0x1F, 0x00, 0xC0, 0x4F, 0xB9, 0x51, 0xED))
+
+CR_SUCCESS                            = 0x00000000
+CR_BUFFER_SMALL                       = 0x0000001A
+CM_GET_DEVICE_INTERFACE_LIST_PRESENT  = 0x00000000
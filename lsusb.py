@@ -1,101 +1,151 @@
 """Script to list USB devices and track list modifications."""
+import email.utils
+import math
 import os
+import pickle
 import sys
 import time
 
+from collections.abc import Iterable
+
 import requests
 
 from ctypes import *
 
-from dateutil.parser import parse as parsedate
-
 from defines import *
 
-VIDPID = {}
-
-SetupAPI = WinDLL('SetupAPI', use_last_error=True)
+from lsusb_core import get_dev_list
+
+NAMES: dict[int, tuple[str, str]] = {}  #(vendor, device) names keyed by (vid << 16) | pid
+VENDORS: dict[int, str] = {}            #vendor names keyed by vid
+IDS_CACHE_VERSION = 2
+
+POLL_MIN = 0.1      #shortest poll delay, seconds
+POLL_MAX = 1.0      #idle poll delay, seconds
+POLL_BURST = 4      #number of scheduled polls after a change
+MEAN_SEED = 0.5     #initial mean interval between related changes, seconds
+MEAN_CAP = 2.0      #longer intervals are counted as this, so idle time doesn't swamp the mean
+EMA_WEIGHT = 0.3    #weight of the newest interval in the mean interval between changes
+
+User32 = WinDLL('User32', use_last_error=True)
+Kernel32 = WinDLL('Kernel32', use_last_error=True)
+
+Kernel32.GetModuleHandleW.restype = c_void_p
+Kernel32.GetModuleHandleW.argtypes = [c_wchar_p]
+User32.DefWindowProcW.restype = LRESULT
+User32.DefWindowProcW.argtypes = [c_void_p, UINT, WPARAM, LPARAM]
+User32.RegisterClassW.restype = c_ushort
+User32.RegisterClassW.argtypes = [POINTER(WNDCLASSW)]
+User32.CreateWindowExW.restype = c_void_p
+User32.CreateWindowExW.argtypes = [
+    DWORD,
+    c_wchar_p,
+    c_wchar_p,
+    DWORD,
+    c_int,
+    c_int,
+    c_int,
+    c_int,
+    c_void_p,
+    c_void_p,
+    c_void_p,
+    c_void_p
+]
+User32.DestroyWindow.argtypes = [c_void_p]
+User32.RegisterDeviceNotificationW.restype = c_void_p
+User32.RegisterDeviceNotificationW.argtypes = [c_void_p, c_void_p, DWORD]
+User32.UnregisterDeviceNotification.argtypes = [c_void_p]
+User32.SetTimer.restype = c_void_p
+User32.SetTimer.argtypes = [c_void_p, c_void_p, UINT, c_void_p]
+User32.GetMessageW.restype = c_int
+User32.GetMessageW.argtypes = [POINTER(MSG), c_void_p, UINT, UINT]
+User32.TranslateMessage.argtypes = [POINTER(MSG)]
+User32.DispatchMessageW.restype = LRESULT
+User32.DispatchMessageW.argtypes = [POINTER(MSG)]
 
 def load_ids() -> None:
     """Load IDs from internet."""
     print ("Loading USB IDs...")
     url = "http://www.linux-usb.org/usb.ids"
     file_name = "usb.ids"
-    local_ts = 0
+    headers = {}
 
     if os.path.exists(file_name):
-        local_ts = int(os.path.getmtime(file_name))
-
-    r = requests.head(url)
-    remote_ts = int(parsedate(r.headers['last-modified']).astimezone().timestamp())
-    if local_ts < remote_ts:
-        r = requests.get(url)
-        if r.status_code != 200:
-            print ("Error downloading USB IDs!")
+        headers["If-Modified-Since"] = email.utils.formatdate(os.path.getmtime(file_name), usegmt=True)
+
+    r = requests.get(url, headers=headers)
+    if r.status_code == 200:
+        with open(file_name, "wb") as file:
+            file.write(r.content)
+    elif r.status_code != 304:
+        print ("Error downloading USB IDs!")
+
+    #unpickling can run arbitrary code, so the cache is trusted as much as
+    #the working directory it is loaded from
+    cache_name = file_name + ".pkl"
+    if os.path.exists(cache_name) and os.path.getmtime(cache_name) >= os.path.getmtime(file_name):
+        try:
+            with open(cache_name, "rb") as file:
+                cache = pickle.load(file)
+            if cache[0] == IDS_CACHE_VERSION:
+                NAMES.update(cache[1])
+                VENDORS.update(cache[2])
+                print ("USB IDs loaded")
+                return
+        except Exception:   #a damaged pickle can raise almost anything
+            NAMES.clear()   #parse usb.ids again
+            VENDORS.clear()
+
+    with open(file_name, "rb") as file:
+        data = file.read()
+    end = data.find(b"# List of known device classes")
+    if end != -1:
+        data = data[:end]   #end of IDs
+
+    vid = 0
+    vid_name = ""
+    for line in data.splitlines():
+        line = line.rstrip()
+        if not line or line[0:1] == b"#" or line[0:2] == b"\t\t":
+            continue
+
+        if line[0:1] == b"\t":
+            pid = int(line[1:5], 16)
+            NAMES[(vid << 16) | pid] = (vid_name, line[7:].decode("utf-8", "replace"))
         else:
-            with open(file_name, "wb") as file:
-                file.write(r.content)
+            vid = int(line[:4], 16)
+            vid_name = line[6:].decode("utf-8", "replace")
+            VENDORS[vid] = vid_name
+
+    #write to a temporary file so an interrupted dump doesn't leave a partial cache
+    with open(cache_name + ".tmp", "wb") as file:
+        pickle.dump((IDS_CACHE_VERSION, NAMES, VENDORS), file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_name + ".tmp", cache_name)
 
-    pids = {}
-    vid = None
-    vid_name = ""
-    with open(file_name, "r") as file:
-        for line in file:
-            line = line.rstrip()
-            if line == "# List of known device classes, subclasses and protocols":
-                break   #end of IDs
-            if line.startswith("#"):
-                continue
-            if line.startswith("\t\t"):
-                continue
-            if not line:
-                continue
-
-            if line.startswith("\t"):
-                pid = int(line[1 : 6], 0x10)
-                descr = line[7:]
-                pids[pid] = descr
-            else:
-                new_vid = int(line[:4], 0x10)
-                if vid is not None:
-                    VIDPID[vid] = {"name" : vid_name, "pids": pids}
-                vid_name = line[6:]
-                pids = {}
-                vid = new_vid
-
-        #and the last element
-        if vid is not None:
-            VIDPID[vid] = {"name" : vid_name, "pids": pids}
-       
     print ("USB IDs loaded")
 
 def usage() -> None:
     """Print usage information."""
     print("Usage: lsusb.py [track]")
 
-def print_devices(vidpids: list[tuple[int, int]]) -> None:
-    """PPrint devices list"""
-    
-    for vid, pid in vidpids:
-        descr = ""
-        vid_info = VIDPID.get(vid)
-        if vid_info:
-            descr = vid_info["name"]
-            pid_info = vid_info["pids"].get(pid, "Unknown device")
-            descr += ", " + pid_info
-        print (f"{vid:04x}:{pid:04x} {descr}")
-
-def print_diff(old: list[tuple[int, int]], new: list[tuple[int, int]]) -> None:
-    """Print diff between device lists"""
-    added = []
-    removed = []
+def describe(vid: int, pid: int) -> str:
+    """Get device description by VID and PID."""
+    info = NAMES.get((vid << 16) | pid)
+    if info:
+        return f"{info[0]}, {info[1]}"
+    vid_name = VENDORS.get(vid)
+    return f"{vid_name}, Unknown device" if vid_name else ""
 
-    for dev in old:
-        if not dev in new:
-            removed.append(dev)
+def print_devices(vidpids: Iterable[tuple[int, int]]) -> None:
+    """PPrint devices list"""
+    lines = [f"{vid:04x}:{pid:04x} {describe(vid, pid)}" for vid, pid in sorted(vidpids)]
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
 
-    for dev in new:
-        if not dev in old:
-            added.append(dev)
+def print_diff(old: frozenset[tuple[int, int]], new: frozenset[tuple[int, int]]) -> None:
+    """Print diff between device lists"""
+    added = new - old
+    removed = old - new
 
     if added:
         print ("Added devices:")
@@ -104,81 +154,112 @@ def print_diff(old: list[tuple[int, int]], new: list[tuple[int, int]]) -> None:
         print ("Removed devices:")
         print_devices(removed)
 
-def extract_ids(path: str) -> tuple[int, int]:
-    """Extract VID and PID from device path."""
-    vid_pos = path.find("vid_")
-    pid_pos = path.find("pid_")
-
-    if vid_pos == -1 or pid_pos == -1:
-        return (0, 0)
-    vid = int(path[vid_pos + 4 : vid_pos + 8], 0x10)
-    pid = int(path[pid_pos + 4 : pid_pos + 8], 0x10)
-    return (vid, pid)
-
-def get_dev_list() -> list[tuple[int, int]]:
-    """Get device VID:PID list"""
-    ret: list[tuple[int, int]] = []
-    guid = GUID(0xA5DCBF10, 0x6530, 0x11D2, (c_ubyte * 8)(0x90, 0x1F, 0x00, 0xC0, 0x4F, 0xB9, 0x51, 0xED))
-    index = 0
-    size = DWORD(0)
-    intf_data = SP_DEVICE_INTERFACE_DATA()
-    intf_data.cbSize = sizeof(SP_DEVICE_INTERFACE_DATA)
-
-    dev_info = SP_DEVINFO_DATA()
-    dev_info.cbSize = sizeof(SP_DEVINFO_DATA)
-
-    SetupAPI.SetupDiGetClassDevsW.restype = c_void_p
-    SetupAPI.SetupDiGetClassDevsW.argtypes = [POINTER(GUID), c_void_p, c_void_p, DWORD]
-    h_devs = SetupAPI.SetupDiGetClassDevsW(byref(guid), None, None, 0x12)   #DIGCF_DEVICEINTERFACE | DIGCF_PRESENT
-    if not h_devs:
-        print (f"Error in SetupDiGetClassDevsW, error code 0x{get_last_error():x}")
-        return ret
-
+def update_devices(prev_list: frozenset[tuple[int, int]]) -> frozenset[tuple[int, int]]:
+    """Get current device list and print changes against the previous one."""
+    new_list = get_dev_list()
+    if new_list != prev_list:
+        print_diff(prev_list, new_list)
+        print ("")
+    return new_list
+
+def poll_schedule(mean_interval: float) -> list[float]:
+    """Get poll delays following a change.
+
+    The time to the next change is assumed to be exponentially distributed
+    with the given mean. Polls are placed at its quantiles, so each one has
+    the same chance of catching the change: dense right after a change and
+    sparser later, all stretched or squeezed by the mean.
+    """
+    delays = []
+    prev = 0.0
+    for i in range(1, POLL_BURST + 1):
+        poll = -mean_interval * math.log(1 - i / (POLL_BURST + 1))
+        delays.append(min(max(poll - prev, POLL_MIN), POLL_MAX))
+        prev = poll
+    return delays
+
+def track_polling(dev_list: frozenset[tuple[int, int]]) -> None:
+    """Track device changes by polling device list."""
+    mean_interval = MEAN_SEED
+    last_change = time.monotonic()
+    next_poll = last_change
+    schedule = iter(poll_schedule(mean_interval))
     while True:
-        SetupAPI.SetupDiEnumDeviceInterfaces.argtypes = [
-            c_void_p,
-            POINTER(SP_DEVINFO_DATA),
-            POINTER(GUID),
-            DWORD,
-            POINTER(SP_DEVICE_INTERFACE_DATA)
-        ]
-        status = SetupAPI.SetupDiEnumDeviceInterfaces(h_devs, None, byref(guid), index, byref(intf_data))
-        if not status:
-            error_code = get_last_error()
-            if error_code != 0x103:     #ERROR_NO_MORE_ITEMS
-                print (f"Error in SetupDiEnumDeviceInterfaces, error code 0x{error_code:x}")
-            break
-
-        SetupAPI.SetupDiGetDeviceInterfaceDetailW.argtypes = [
-            c_void_p,
-            POINTER(SP_DEVICE_INTERFACE_DATA),
-            c_void_p,
-            DWORD,
-            POINTER(DWORD),
-            POINTER(SP_DEVINFO_DATA)
-        ]
-
-        SetupAPI.SetupDiGetDeviceInterfaceDetailW(h_devs, byref(intf_data), None, 0, byref(size), None)
-        class INTF_DETAIL(Structure):
-            """Inline class for storing device details. Size is defined in runtime"""
-            _fields_ = [
-                ('cbSize', DWORD),
-                ('DevicePath', c_wchar * size.value),
-            ]
-
-        details = INTF_DETAIL()
-        details.cbSize = 8      #size of DWORD and 1-char buffer
-        if not SetupAPI.SetupDiGetDeviceInterfaceDetailW(h_devs, byref(intf_data), byref(details), sizeof(details), byref(size), None):
-            print (f"Error in SetupDiGetDeviceInterfaceDetailW_2, error code 0x{get_last_error():x}")
-            break
-
-        ret.append(extract_ids(details.DevicePath))
-
-        index += 1
-
-    SetupAPI.SetupDiDestroyDeviceInfoList.argtypes = [c_void_p]
-    SetupAPI.SetupDiDestroyDeviceInfoList(h_devs)
-    return ret
+        next_poll += next(schedule, POLL_MAX)
+        time.sleep(max(next_poll - time.monotonic(), 0))
+
+        new_list = update_devices(dev_list)
+        if new_list != dev_list:
+            now = time.monotonic()
+            mean_interval += EMA_WEIGHT * (min(now - last_change, MEAN_CAP) - mean_interval)
+            last_change = now
+            next_poll = now
+            schedule = iter(poll_schedule(mean_interval))
+        dev_list = new_list
+
+def track_notifications(dev_list: frozenset[tuple[int, int]]) -> frozenset[tuple[int, int]]:
+    """Track device changes using WM_DEVICECHANGE notifications.
+
+    Returns the last known device list if notifications can't be set up
+    or the message loop fails.
+    """
+    class_name = "lsusb_py"
+
+    def wnd_proc(hwnd, msg, w_param, l_param):
+        nonlocal dev_list
+        if msg == WM_DEVICECHANGE and w_param in (DBT_DEVICEARRIVAL, DBT_DEVICEREMOVECOMPLETE):
+            dev_list = update_devices(dev_list)
+        return User32.DefWindowProcW(hwnd, msg, w_param, l_param)
+
+    h_instance = Kernel32.GetModuleHandleW(None)
+
+    wnd_class = WNDCLASSW()
+    wnd_class.lpfnWndProc = WNDPROC(wnd_proc)     #keep reference while the window is alive
+    wnd_class.hInstance = h_instance
+    wnd_class.lpszClassName = class_name
+
+    if not User32.RegisterClassW(byref(wnd_class)):
+        print (f"Error in RegisterClassW, error code 0x{get_last_error():x}")
+        return dev_list
+
+    hwnd = User32.CreateWindowExW(0, class_name, None, 0, 0, 0, 0, 0, HWND_MESSAGE, None, h_instance, None)
+    if not hwnd:
+        print (f"Error in CreateWindowExW, error code 0x{get_last_error():x}")
+        return dev_list
+
+    notify_filter = DEV_BROADCAST_DEVICEINTERFACE_W()
+    notify_filter.dbcc_size = sizeof(DEV_BROADCAST_DEVICEINTERFACE_W)
+    notify_filter.dbcc_devicetype = DBT_DEVTYP_DEVICEINTERFACE
+    notify_filter.dbcc_classguid = GUID_DEVINTERFACE_USB_DEVICE
+
+    h_notify = User32.RegisterDeviceNotificationW(hwnd, byref(notify_filter), DEVICE_NOTIFY_WINDOW_HANDLE)
+    if not h_notify:
+        print (f"Error in RegisterDeviceNotificationW, error code 0x{get_last_error():x}")
+        User32.DestroyWindow(hwnd)
+        return dev_list
+
+    #catch changes made before the notifications were registered
+    dev_list = update_devices(dev_list)
+
+    #GetMessageW blocks without returning to the interpreter, so a timer
+    #wakes the loop up periodically to let Ctrl+C through
+    User32.SetTimer(hwnd, 1, 500, None)
+
+    msg = MSG()
+    try:
+        while True:
+            status = User32.GetMessageW(byref(msg), None, 0, 0)
+            if status == -1:
+                print (f"Error in GetMessageW, error code 0x{get_last_error():x}")
+                break
+            if status == 0:     #WM_QUIT
+                break
+            User32.TranslateMessage(byref(msg))
+            User32.DispatchMessageW(byref(msg))
+    finally:
+        User32.UnregisterDeviceNotification(h_notify)
+        User32.DestroyWindow(hwnd)
+    return dev_list
 
 def main() -> None:
     """Main function."""
@@ -201,13 +282,8 @@ def main() -> None:
 
     if mode == "track":
         print ("")
-        while True:
-            new_list = get_dev_list()
-            if new_list != prev_list:
-                print_diff(prev_list, new_list)
-                print ("")
-                prev_list = new_list
-            time.sleep(0.1)
+        prev_list = track_notifications(prev_list)
+        track_polling(prev_list)   #fallback if notifications don't work
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,44 @@
+"""USB device enumeration through Configuration Manager."""
+import re
+
+from ctypes import *
+
+from defines import *
+
+ID_RE = re.compile(r"vid_([0-9a-f]{4}).*?pid_([0-9a-f]{4})", re.IGNORECASE)
+
+CfgMgr32 = WinDLL('CfgMgr32', use_last_error=True)
+
+CfgMgr32.CM_Get_Device_Interface_List_SizeW.argtypes = [POINTER(c_ulong), POINTER(GUID), c_wchar_p, c_ulong]
+CfgMgr32.CM_Get_Device_Interface_ListW.argtypes = [POINTER(GUID), c_wchar_p, c_void_p, c_ulong, c_ulong]
+
+def extract_ids(path: str) -> tuple[int, int]:
+    """Extract VID and PID from device path."""
+    match = ID_RE.search(path)
+    if not match:
+        return (0, 0)
+    return (int(match.group(1), 0x10), int(match.group(2), 0x10))
+
+def get_dev_list() -> frozenset[tuple[int, int]]:
+    """Get device VID:PID set"""
+    guid = GUID_DEVINTERFACE_USB_DEVICE
+    size = c_ulong(0)
+
+    while True:
+        status = CfgMgr32.CM_Get_Device_Interface_List_SizeW(byref(size), byref(guid), None, CM_GET_DEVICE_INTERFACE_LIST_PRESENT)
+        if status != CR_SUCCESS:
+            print (f"Error in CM_Get_Device_Interface_List_SizeW, error code 0x{status:x}")
+            return frozenset()
+
+        buffer = (c_wchar * size.value)()
+        status = CfgMgr32.CM_Get_Device_Interface_ListW(byref(guid), None, buffer, size.value, CM_GET_DEVICE_INTERFACE_LIST_PRESENT)
+        if status == CR_BUFFER_SMALL:
+            continue    #device added between the calls
+        if status != CR_SUCCESS:
+            print (f"Error in CM_Get_Device_Interface_ListW, error code 0x{status:x}")
+            return frozenset()
+        break
+
+    #multi-sz: paths separated by NULs, terminated by an empty string
+    paths = buffer[:].split("\0")
+    return frozenset(map(extract_ids, filter(None, paths)))